@@ -1,8 +1,13 @@
-from dataclasses import dataclass
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
 
-import boto3
 import logging
 
+if TYPE_CHECKING:
+    import boto3
+
 log = logging.getLogger("aws_config")
 
 
@@ -13,12 +18,19 @@ class AwsSettings:
     account_id: str = None
     profile: str = None
 
+    # Session (and clients) are expensive to create, so are created once and re-used
+    _session_cache: boto3.Session = field(default=None, init=False, repr=False, compare=False)
+    _clients: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+
     def client(self, service):
-        session = self._session()
-        log.info(f"client({service}), account_id={self.account_id}")
-        return session.client(service, region_name=self.region)
+        if service not in self._clients:
+            session = self._session()
+            log.info(f"client({service}), account_id={self.account_id}")
+            self._clients[service] = session.client(service, region_name=self.region)
+        return self._clients[service]
 
     def resource(self, service):
+        # Unlike clients, boto3 resources aren't thread safe so aren't shared - callers should re-use them instead
         session = self._session()
         log.info(f"resource({service}), account_id={self.account_id}")
         return session.resource(service, region_name=self.region)
@@ -31,19 +43,24 @@ class AwsSettings:
         return self.account_id
 
     def _session(self):
+        if self._session_cache:
+            return self._session_cache
+
+        # boto3 is slow to import, so only import it once we actually need to talk to AWS
+        import boto3
+
         if self.profile:
             session = boto3.Session(profile_name=str(self.profile))
         else:
             session = boto3.Session()
 
-        if not hasattr(self, "_checked_account"):
-            sts = session.client("sts")
-            account_id = sts.get_caller_identity()["Account"]
-            if self.account_id:
-                if str(account_id) != str(self.account_id):
-                    raise Exception(f"Incorrect AWS Account - expected {self.account_id}, but appear to be using {account_id} ")
+        sts = session.client("sts")
+        account_id = sts.get_caller_identity()["Account"]
+        if self.account_id:
+            if str(account_id) != str(self.account_id):
+                raise Exception(f"Incorrect AWS Account - expected {self.account_id}, but appear to be using {account_id} ")
 
-            self._checked_account = True
-            self.account_id = account_id
+        self.account_id = account_id
+        self._session_cache = session
 
         return session
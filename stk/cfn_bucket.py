@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-import boto3
+import io
 import botocore
 
 from dataclasses import dataclass
@@ -38,6 +38,11 @@ class CfnBucketObject:
 class CfnBucket:
     FORCE_OVERWRITE = False
 
+    # Objects larger than this are uploaded as multipart, with parts uploaded concurrently
+    MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    MAX_CONCURRENCY = 16
+
     def __init__(self, config: AwsSettings):
         self.bucket_name = config.cfn_bucket
         self.region = config.region
@@ -48,14 +53,31 @@ class CfnBucket:
         s3 = self.s3
 
         if self.FORCE_OVERWRITE:
-            s3.put_object(Bucket=self.bucket_name, Key=object.key(), Body=object.body(), ServerSideEncryption="AES256")
+            self._put(object)
         else:
             try:
                 s3.head_object(Bucket=self.bucket_name, Key=object.key())
                 # print(f"Key {object.key()} already exists in {self.bucket_name}, not uploading")
             except botocore.exceptions.ClientError as ex:
                 if ex.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
-                    s3.put_object(Bucket=self.bucket_name, Key=object.key(), Body=object.body(), ServerSideEncryption="AES256")
+                    self._put(object)
                 else:
                     raise
         return CfnBucketObject(self, object.key())
+
+    def _put(self, object: Uploadable):
+        # boto3 is slow to import, and only needed once we actually upload something
+        from boto3.s3.transfer import TransferConfig
+
+        config = TransferConfig(
+            multipart_threshold=self.MULTIPART_THRESHOLD,
+            multipart_chunksize=self.MULTIPART_CHUNKSIZE,
+            max_concurrency=self.MAX_CONCURRENCY,
+            use_threads=True,
+        )
+
+        body = object.body()
+        if isinstance(body, bytes):
+            body = io.BytesIO(body)
+
+        self.s3.upload_fileobj(body, Bucket=self.bucket_name, Key=object.key(), ExtraArgs={"ServerSideEncryption": "AES256"}, Config=config)
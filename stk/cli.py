@@ -5,7 +5,6 @@ from __future__ import annotations
 import functools
 import typing
 import click
-import boto3
 import json
 import yaml
 
@@ -119,6 +118,8 @@ def stk():
 
     log_level = environ.get("LOG_LEVEL", None)
     if log_level:
+        import boto3
+
         boto3.set_stream_logger("boto3", level=log_level)
         boto3.set_stream_logger("botocore", level=log_level)
         boto3.set_stream_logger("boto3.resources", level=log_level)
@@ -4,16 +4,23 @@ import pathlib
 import re
 import os
 import logging
-import git
 
 from dataclasses import dataclass
 from datetime import datetime
-from jinja2 import Environment, StrictUndefined
+from functools import cached_property, lru_cache
 from pathlib import Path
 from rich.console import Console
 from rich.table import Table
 from sys import exc_info
-from yaml import safe_load
+from types import MappingProxyType
+from yaml import load
+
+# libyaml's (C) loader is several times faster than PyYAML's pure python loader, which dominates the cost of
+# interpolating config values. Fall back to the pure python loader if PyYAML was built without libyaml.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 from . import ConfigException, VERSION
@@ -21,10 +28,40 @@ from .config_file import ConfigFile
 from .template_source import TemplateSource
 from .basic_stack import StackReference
 from .aws_config import AwsSettings
+from .jinja_env import compile_template, needs_rendering, render_plain
 
 log = logging.getLogger("config")
 
 
+def safe_load(stream):
+    return load(stream, Loader=SafeLoader)
+
+
+# Strings YAML loads as exactly the same string - i.e. they aren't numbers, booleans, null, quoted, flow collections,
+# mappings, comments etc. Most interpolated values are like this, so we can skip the YAML parser for them.
+_PLAIN_STRING = re.compile(r"[A-Za-z_][\w .,/()+@=-]*").fullmatch
+_YAML_KEYWORDS = {"yes", "no", "true", "false", "on", "off", "null"}
+
+
+def _load_value(value: str):
+    if _PLAIN_STRING(value) and not value.endswith(" ") and value.lower() not in _YAML_KEYWORDS:
+        return value
+    return safe_load(value)
+
+
+@lru_cache(maxsize=16)
+def _git_head(config_path: str) -> tuple:
+    """
+    Returns (sha, ref) of HEAD for git repository containing config_path. Finding and loading the repository
+    is slow, and configs from the same directory share it, so this is cached.
+    """
+    # git is slow to import, so only import it once we need it
+    import git
+
+    head = git.Repo(config_path).head
+    return str(head.commit.hexsha), str(head.reference)
+
+
 class Config:
     @dataclass
     class InterpolationError:
@@ -37,16 +74,19 @@ class Config:
         # Attributes
         stack_name: str
         environments: list = None
+        lambda_compress_level: int = 1  # DEFLATE level (0-9) for lambda_uri/lambda_code zips
 
         # DEFAULTS are pre-interpolation values so can't set them via attributes
         DEFAULTS = {"stack_name": "{{ environment }}-{{ name.replace('/', '-') }}"}
 
-        # stack name
-        valid_stack_name = re.compile("^[a-zA-Z0-9-]+$").match
+        # stack name. fullmatch, as '$' would also allow a trailing newline
+        valid_stack_name = re.compile("[a-zA-Z0-9-]+").fullmatch
 
         def __post_init__(self):
-            if type(self.stack_name) != str or not self.valid_stack_name(self.stack_name):
+            if not isinstance(self.stack_name, str) or not self.valid_stack_name(self.stack_name):
                 raise ValueError(f"Stack name {self.stack_name} is invalid. Can contain only alphanumeric characters and hyphens")
+            if not isinstance(self.lambda_compress_level, int) or not 0 <= self.lambda_compress_level <= 9:
+                raise ValueError(f"lambda_compress_level {self.lambda_compress_level} is invalid. Must be 0-9")
 
     class Vars(dict):
         MAX_INTERPOLATION_DEPTH = 10
@@ -73,34 +113,42 @@ class Config:
 
             Returns dict InterpolationError for all keys that can't be expanded
             """
-            env = Environment(undefined=StrictUndefined)
-
-            interpolation_depth = 0
+            # Worklist of keys still to be expanded, in a stable (sorted) order. Keys expanded earlier in a
+            # pass are available to later keys in the same pass.
+            pending = sorted(vars.keys())
 
             errors = {}
-            while interpolation_depth <= self.MAX_INTERPOLATION_DEPTH:
-                interpolation_depth += 1
-                unexpanded_keys = sorted(set(vars.keys()) - set(self.keys()))
-                if not unexpanded_keys:
+            for _ in range(self.MAX_INTERPOLATION_DEPTH + 1):
+                if not pending:
                     return None
 
-                for key in unexpanded_keys:
+                unexpanded = []
+                for key in pending:
                     value = vars[key]
                     try:
-                        del errors[key]
-                        if type(value) in [bool, dict, list, str]:
-                            tpl = env.from_string(str(value))  # convert value to jinja2 template
-                            result = str(tpl.render(self))
-                            self[key] = safe_load(result)
+                        if isinstance(value, (bool, dict, list, str)):
+                            result = str(value)
+                            if needs_rendering(result):
+                                tpl = compile_template(result)  # convert value to jinja2 template
+                                result = str(tpl.render(self))
+                            else:
+                                result = render_plain(result)
+                            self[key] = _load_value(result)
                             # print(f"expanding {key}, {value}({type(value)}) -> {self[key]}({type(self[key])})")
                         else:
                             # print(f"skipping {key}, type={type(value)}")
                             self[key] = value  # Don't try and process this value as Jinja template
-                        del vars[key]
+                        errors.pop(key, None)
                     except Exception:
                         errors[key] = Config.InterpolationError(key, value, exc_info()[1])
+                        unexpanded.append(key)
+
+                # No progress made, so another pass would fail in exactly the same way
+                if len(unexpanded) == len(pending):
+                    break
+                pending = unexpanded
 
-            return errors
+            return errors if pending else None
 
     class InterpolatedDict(dict):
         def __init__(self, object: dict, vars: dict):
@@ -109,18 +157,20 @@ class Config:
             if not object:
                 return
 
-            if type(object) != dict:
+            if not isinstance(object, dict):
                 raise Exception(object)
 
-            env = Environment(undefined=StrictUndefined)
-
             for k, v in object.items():
                 try:
                     if v == None:
                         self[k] = None
                     else:
-                        value = env.from_string(str(v)).render(vars)
-                        parsed_value = safe_load(value)
+                        value = str(v)
+                        if needs_rendering(value):
+                            value = compile_template(value).render(vars)
+                        else:
+                            value = render_plain(value)
+                        parsed_value = _load_value(value)
                         if parsed_value != None:
                             self[k] = parsed_value
                 except Exception as ex:
@@ -128,10 +178,9 @@ class Config:
 
     class Tags(InterpolatedDict):
         def to_list(self, extra_attributes={}):
-            ret_val = []
-            for k, v in self.items():
-                ret_val.append({"Key": str(k), "Value": str(v), **extra_attributes})
-            return ret_val
+            if not extra_attributes:
+                return [{"Key": str(k), "Value": str(v)} for k, v in self.items()]
+            return [{"Key": str(k), "Value": str(v), **extra_attributes} for k, v in self.items()]
 
     class StackRefs:
         DEFAULTS = {"stack_name": "{{ environment }}-{{ name }}", "optional": False}
@@ -142,7 +191,7 @@ class Config:
             log.debug("defined refs: %s" % self.refs)
 
         def __contains__(self, name: str) -> bool:
-            return name in self.stacks()
+            return name in self.stacks
 
         def __getitem__(self, name: str) -> str:
             return self.stack(name)
@@ -165,7 +214,7 @@ class Config:
             """
             Returns stack object, or None if stack is optional but is not found
             """
-            stacks = self.stacks()
+            stacks = self.stacks
             if name not in stacks:
                 stack_names = sorted(self.refs.keys())
                 raise Exception(f"Attempt to access stack {name}, but it's not defined in config.refs - only {', '.join(stack_names)} are defined")
@@ -190,43 +239,43 @@ class Config:
                 For references, cache the describe_stack - we're not expecting
                 it to change.
                 """
-                if not hasattr(self, "_describe_stack_result"):
+                if "_describe_stack_result" not in self.__dict__:
                     self._describe_stack_result = super().describe_stack()
                 return self._describe_stack_result
 
+        @cached_property
         def stacks(self) -> dict:
-            if not hasattr(self, "_stacks"):
-                # _stacks is dict of {name => StackReference() for each named stack. This includes
-                # stacks that don't exist.
-                self._stacks = dict()
-                for name, cfg in self.refs.items():
-                    if name == "environment":
-                        continue
-
-                    if not cfg:
-                        cfg = {}
-
-                    if not issubclass(type(cfg), dict):
-                        print(f"{name} is not a valid stack reference definition (from {self.refs})")
-                        exit(-1)
-
-                    # Try building dict of options. This can fail if interpolating incorrect variable or
-                    try:
-                        final_opts = Config.InterpolatedDict({**self.DEFAULTS, **cfg}, {"environment": self.config.environment, "name": name.replace("_", "-")})
-                    except Exception as ex:
-                        print(f"Unable to process settings for stack reference {name} -> {cfg} (from {self.refs})")
-                        exit(-1)
+            # dict of {name => StackReference() for each named stack. This includes
+            # stacks that don't exist.
+            stacks = dict()
+            for name, cfg in self.refs.items():
+                if name == "environment":
+                    continue
 
-                    try:
-                        log.info(f"stack reference {name}: {final_opts}")
-                        opts = self.StackRefOpts(**final_opts)
-                    except Exception as ex:
-                        log.exception(f"Invalid configuration for stack.refs '{name}' {self.refs}: {ex}", exc_info=ex)
-                        raise
+                if not cfg:
+                    cfg = {}
+
+                if not issubclass(type(cfg), dict):
+                    print(f"{name} is not a valid stack reference definition (from {self.refs})")
+                    exit(-1)
+
+                # Try building dict of options. This can fail if interpolating incorrect variable or
+                try:
+                    final_opts = Config.InterpolatedDict({**self.DEFAULTS, **cfg}, {"environment": self.config.environment, "name": name.replace("_", "-")})
+                except Exception as ex:
+                    print(f"Unable to process settings for stack reference {name} -> {cfg} (from {self.refs})")
+                    exit(-1)
+
+                try:
+                    log.info(f"stack reference {name}: {final_opts}")
+                    opts = self.StackRefOpts(**final_opts)
+                except Exception as ex:
+                    log.exception(f"Invalid configuration for stack.refs '{name}' {self.refs}: {ex}", exc_info=ex)
+                    raise
 
-                    self._stacks[name] = self.OptionalStackReference(aws=self.config.aws, name=opts.stack_name, optional=opts.optional)
+                stacks[name] = self.OptionalStackReference(aws=self.config.aws, name=opts.stack_name, optional=opts.optional)
 
-            return self._stacks
+            return stacks
 
     @dataclass
     class DeployMetadata:
@@ -244,9 +293,7 @@ class Config:
 
             # Config git HEAD state
             try:
-                config_head = git.Repo(config_path).head
-                self.config_sha = str(config_head.commit.hexsha)
-                self.config_ref = str(config_head.reference)
+                self.config_sha, self.config_ref = _git_head(str(config_path))
             except Exception as ex:
                 log.warning("Unable to retrieve git info for config project", exc_info=ex)
                 self.config_sha = "?"
@@ -279,12 +326,17 @@ class Config:
         if environment not in cfg.environments():
             raise ConfigException(f"Environment {environment} is not a valid environment for {cfg.filename}. Only {cfg.environments()} permitted.")
 
-        # Load top-level config file and all included configs
+        # Load top-level config file and all included configs, and merge each section (vars, params etc.)
         includes = cfg.load_includes()
+        sections = includes.fetch_all(environment)
+
+        # Read-only snapshot of the process environment shared by all interpolation contexts. It's not a dict,
+        # so Vars passes it through as-is rather than trying to interpolate it.
+        environ = MappingProxyType(dict(os.environ))
 
         # Most other config supports pulling stuff from AWS, so initialize this first
         try:
-            aws_settings = self.InterpolatedDict(includes.fetch_dict("aws", environment), {"environ": os.environ, "environment": environment})
+            aws_settings = self.InterpolatedDict(sections["aws"], {"environ": environ, "environment": environment})
             self.aws = AwsSettings(**aws_settings)
             self.aws.get_account_id()  # force retrieval of account_id
         except TypeError as ex:
@@ -295,7 +347,7 @@ class Config:
             "account_id": self.aws.account_id,
             "aws_region": self.aws.region,
             "cfn_bucket": self.aws.cfn_bucket,
-            "environ": os.environ,
+            "environ": environ,
             "environment": environment,
             "name": name,
         }
@@ -304,7 +356,7 @@ class Config:
         # etc.
         self.core = self.CoreSettings(
             **self.InterpolatedDict(
-                includes.fetch_dict("core", environment, self.CoreSettings.DEFAULTS),
+                {**self.CoreSettings.DEFAULTS, **sections["core"]},
                 default_vars,
             )
         )
@@ -315,29 +367,25 @@ class Config:
         # Stack 'refs' object references external stacks. They are intended to be resolved by 'vars'/'params' so need to be
         # loaded first
         try:
-            refs = self.InterpolatedDict(includes.fetch_dict("refs", environment), {"environment": environment})
+            refs = self.InterpolatedDict(sections["refs"], {"environment": environment})
             self.refs = self.StackRefs(refs, self)
         except Exception as ex:
             raise Exception("Unable to parse stack refs (refs:). have {refs}: {ex}")
         default_vars["refs"] = self.refs
 
-        self.helpers = list(includes.fetch_set("helpers", environment))
+        self.helpers = list(sections["helpers"])
 
-        pre_vars = includes.fetch_dict("vars", environment, default_vars)
+        pre_vars = {**default_vars, **sections["vars"]}
         pre_vars.update(var_overrides)
         self.vars = self.Vars(pre_vars)
 
-        params = includes.fetch_dict("params", environment)
+        params = dict(sections["params"])
         params.update(param_overrides)
         self.params = self.InterpolatedDict(params, self.vars)
         self.vars["params"] = self.params
 
         template_source = self.InterpolatedDict(
-            includes.fetch_dict(
-                "template",
-                environment,
-                {"name": name.replace("/", "-"), "root": None},
-            ),
+            {"name": name.replace("/", "-"), "root": None, **sections["template"]},
             self.vars,
         )
 
@@ -356,7 +404,7 @@ class Config:
         # Deploy metadata is used to track deploys back to version controlled config/templates.
         self.vars["deploy"] = self.DeployMetadata(config_path=config_path, template_source=self.template_source)
 
-        self.tags = self.Tags(includes.fetch_dict("tags", environment), self.vars)
+        self.tags = self.Tags(sections["tags"], self.vars)
 
         # perform final linting/validation
         includes.validate(self)
@@ -9,32 +9,44 @@ log = logging.getLogger("config_file")
 
 
 class ConfigFiles(list):
-    def fetch_dict(self, key, environment, defaults: dict = {}):
-        ret_val = dict(defaults)
+    # Top-level keys that are merged across config files (see fetch_all)
+    DICT_KEYS = ["aws", "core", "params", "refs", "tags", "template", "vars"]
+    SET_KEYS = ["helpers"]
+
+    def fetch_all(self, environment) -> dict:
+        """
+        Returns dict of { key => merged value } for all DICT_KEYS and SET_KEYS, walking the config files
+        once rather than once per key. Environment-specific values take priority over top-level ones, and later
+        files over earlier ones.
+        """
+        ret_val = {key: {} for key in self.DICT_KEYS}
+        ret_val.update({key: set() for key in self.SET_KEYS})
 
         for config_file in self:
-            # Top-level key in file is lowest priority
-            try:
-                ret_val.update(config_file.get(key, {}))
-            except TypeError as ex:
-                self.report_error(f"Unable to retrieve top-level key '{key}'", config_file, key, ex)
-
-            # Environment-specific key is higher priority
-            try:
-                ret_val.update(config_file.environment(environment).get(key, {}))
-            except TypeError as ex:
-                self.report_error(f"Unable to retrieve {key} from environments.{environment}", config_file, key, ex)
+            env_config = config_file.environment(environment)
+            for key in self.DICT_KEYS:
+                self._merge_dict(ret_val[key], config_file, env_config, key, environment)
+            for key in self.SET_KEYS:
+                self._merge_set(ret_val[key], config_file, env_config, key)
 
         return ret_val
 
-    def fetch_set(self, key, environment, defaults: list = []):
-        ret_val = set(defaults)
+    def _merge_dict(self, ret_val: dict, config_file: ConfigFile, env_config: dict, key, environment):
+        # Top-level key in file is lowest priority
+        try:
+            ret_val.update(config_file.get(key, {}))
+        except TypeError as ex:
+            self.report_error(f"Unable to retrieve top-level key '{key}'", config_file, key, ex)
 
-        for config_file in self:
-            ret_val.update(config_file.get(key, []))
-            ret_val.update(config_file.environment(environment).get(key, []))
+        # Environment-specific key is higher priority
+        try:
+            ret_val.update(env_config.get(key, {}))
+        except TypeError as ex:
+            self.report_error(f"Unable to retrieve {key} from environments.{environment}", config_file, key, ex)
 
-        return ret_val
+    def _merge_set(self, ret_val: set, config_file: ConfigFile, env_config: dict, key):
+        ret_val.update(config_file.get(key, []))
+        ret_val.update(env_config.get(key, []))
 
     def validate(self, config):
         valid_environments = config.core.environments
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+import re
+import logging
+
+from functools import lru_cache
+from jinja2 import Environment, FileSystemBytecodeCache, StrictUndefined, Template
+
+log = logging.getLogger("jinja_env")
+
+# Sources longer than this are compiled on every call rather than cached so a few large, one-off
+# sources (e.g. whole templates) can't pin lots of memory in the cache.
+MAX_CACHED_SOURCE_LENGTH = 4096
+
+# Compiled templates are persisted here between runs
+BYTECODE_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")), "stk", "jinja")
+
+VARS_ENV = Environment(undefined=StrictUndefined)
+"""Environment used to interpolate config values (vars, params, tags etc.)"""
+
+TEMPLATE_ENV = Environment(
+    line_statement_prefix="##",
+    undefined=StrictUndefined,
+    bytecode_cache=FileSystemBytecodeCache(directory=BYTECODE_CACHE_DIR),
+)
+"""Environment used for templates and template files (supports '##' line statements)"""
+
+
+def compile_template(source: str, env: Environment = VARS_ENV) -> Template:
+    """
+    Returns compiled Jinja2 template for source. Config values are tiny strings that get
+    re-interpolated many times, so compiled templates are cached by source.
+    """
+    if len(source) > MAX_CACHED_SOURCE_LENGTH:
+        return env.from_string(source)
+    return _compile(source, env)
+
+
+@lru_cache(maxsize=2048)
+def _compile(source: str, env: Environment) -> Template:
+    return env.from_string(source)
+
+
+def needs_rendering(source: str, env: Environment = VARS_ENV) -> bool:
+    """
+    Returns True if source contains any Jinja2 syntax for env. Sources without any can be used as-is,
+    rendering them would return the same string.
+    """
+    return _markers(env)(source) is not None
+
+
+_NEWLINE = re.compile(r"\r\n|\r|\n")
+
+
+def render_plain(source: str, env: Environment = VARS_ENV) -> str:
+    """
+    Returns what rendering source would, for sources without any Jinja2 syntax (see needs_rendering). Rendering
+    still normalises line breaks and drops a single trailing newline.
+    """
+    if "\n" not in source and "\r" not in source:
+        return source
+    lines = _NEWLINE.split(source)
+    if not env.keep_trailing_newline and lines[-1] == "":
+        del lines[-1]
+    return env.newline_sequence.join(lines)
+
+
+@lru_cache(maxsize=None)
+def _markers(env: Environment):
+    patterns = [re.escape(s) for s in (env.block_start_string, env.variable_start_string, env.comment_start_string)]
+    if env.line_statement_prefix:
+        # Jinja2 treats \r and \r\n as line breaks too
+        patterns.append(r"(?:^|(?<=\r))[ \t\v]*" + re.escape(env.line_statement_prefix))
+    if env.line_comment_prefix:
+        # Line comments can start after any non-whitespace, so look for the prefix anywhere
+        patterns.append(re.escape(env.line_comment_prefix))
+    return re.compile("|".join(patterns), re.MULTILINE).search
+
+
+def load_template(name: str, source: str, env: Environment = TEMPLATE_ENV) -> Template:
+    """
+    Returns compiled Jinja2 template for a (potentially large) template source, using the environment's
+    bytecode cache so compilation is skipped if the same source was compiled by a previous run.
+
+    The cache is keyed by name, but bytecode is only re-used if the source is unchanged.
+    """
+    cache = env.bytecode_cache
+    if not cache or not _cache_dir_exists(cache.directory):
+        return env.from_string(source)
+
+    bucket = cache.get_bucket(env, name, None, source)
+    if bucket.code is None:
+        bucket.code = env.compile(source, name)
+        try:
+            cache.set_bucket(bucket)
+        except OSError as ex:
+            log.warning(f"Unable to write template bytecode cache in {cache.directory}", exc_info=ex)
+
+    return env.template_class.from_code(env, bucket.code, env.make_globals(None))
+
+
+@lru_cache(maxsize=None)
+def _cache_dir_exists(directory: str) -> bool:
+    try:
+        os.makedirs(directory, exist_ok=True)
+        return True
+    except OSError as ex:
+        log.warning(f"Unable to create template bytecode cache {directory}", exc_info=ex)
+        return False
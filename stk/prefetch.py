@@ -0,0 +1,58 @@
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import Iterable, Iterator
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+def prefetch(items: Iterable, size: int) -> Iterator:
+    """
+    Iterate over items in a background thread, keeping up to `size` items buffered ahead of the consumer. This
+    lets slow producers (e.g. reading files from a provider) overlap with work done on each item.
+
+    Exceptions raised by the producer are re-raised in the consumer. If the consumer stops early, the producer
+    is stopped too (and waited for).
+    """
+    queue = Queue(maxsize=size)
+    stopped = Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as ex:
+            put(_Failed(ex))
+        else:
+            put(_DONE)
+
+    producer = Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        # Wait for the producer to actually stop, so callers can safely use whatever it was reading from again
+        stopped.set()
+        producer.join()
@@ -1,15 +1,19 @@
 from __future__ import annotations
 
+import io
 import os
 import stat
-import giturlparse
 import urllib
 import logging
 
 from dataclasses import dataclass
-from git import Repo
+from functools import partial
 from os import path, walk
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from git import Repo
 
 log = logging.getLogger("provider")
 
@@ -30,7 +34,19 @@ class GenericProvider:
     def is_dir(self, *_) -> bool:
         pass
 
-    def find(self, dir: str, ignore: function):
+    def find(self, dir: str, ignore: Callable[[str], bool] = None):
+        """
+        Yields (path, type, content) for each file in dir
+        """
+        for file_path, type, _, opener in self.find_openers(dir, ignore):
+            with opener() as f:
+                yield (file_path, type, f.read())
+
+    def find_openers(self, dir: str, ignore: Callable[[str], bool] = None):
+        """
+        Yields (path, type, size, opener) for each file in dir, where opener() returns a binary file object for the
+        content. This lets large files be streamed rather than read into memory.
+        """
         pass
 
 
@@ -55,7 +71,7 @@ class FilesystemProvider(GenericProvider):
     def is_tree(self, *p) -> bool:
         return path.isdir(path.join(self.root, *p))
 
-    def find(self, dir, ignore=None):
+    def find_openers(self, dir, ignore=None):
         start_dir = path.abspath(path.join(self.root, dir))
 
         if not path.exists(start_dir):
@@ -74,10 +90,10 @@ class FilesystemProvider(GenericProvider):
 
                 st = os.lstat(file_path)
                 if stat.S_ISREG(st.st_mode):
-                    yield (relative_path, "file", self.content(file_path))
+                    yield (relative_path, "file", st.st_size, partial(open, file_path, "rb"))
                 elif stat.S_ISLNK(st.st_mode):
-                    target = os.readlink(file_path)
-                    yield (relative_path, "symlink", target)
+                    target = os.readlink(file_path).encode("utf-8")
+                    yield (relative_path, "symlink", len(target), partial(io.BytesIO, target))
                 else:
                     raise Exception("Unsupported filesystem object at " + file_path)
 
@@ -96,6 +112,10 @@ class GitProvider(GenericProvider):
     repo: Repo = None
 
     def __post_init__(self):
+        # git/giturlparse are slow to import and not needed for filesystem templates
+        import giturlparse
+        from git import Repo
+
         if self.root.endswith("/"):
             self.root = self.root[:-1]
 
@@ -165,7 +185,7 @@ class GitProvider(GenericProvider):
         except KeyError:
             return False
 
-    def find(self, dir, ignore=None):
+    def find_openers(self, dir, ignore=None):
         if dir.endswith("/"):
             dir = dir[:-1]
 
@@ -181,7 +201,10 @@ class GitProvider(GenericProvider):
                     type = "symlink"
                 else:
                     type = "file"
-                yield (item_path, type, item.data_stream.read())
+                # GitPython's object database can't be used from more than one thread, so read blobs here rather than
+                # in the opener (which may be called from another thread)
+                data = item.data_stream.read()
+                yield (item_path, type, len(data), partial(io.BytesIO, data))
 
 
 def provider(source):
@@ -1,17 +1,20 @@
 from __future__ import annotations
 
 import hashlib
+import io
 import re
 import logging
 
+from functools import cached_property
+from itertools import islice
 from typing import List
 from cfn_tools import load_yaml
-from jinja2 import Environment, StrictUndefined
 
 from .provider import GenericProvider
 from .config import Config
 from .template_helpers import TemplateHelpers
 from .cfn_bucket import CfnBucket, Uploadable
+from .jinja_env import load_template
 
 log = logging.getLogger("template")
 
@@ -49,14 +52,13 @@ class FailedTemplate(dict):
         return f"{str(self.error)}\n{self.location} at line {line_no}:\n\n{self.source_context(line_no)}\n\n"
 
     def source_context(self, line_no: int) -> str:
-        lines = self.source.split("\n")
-
         from_line = max(1, line_no - self.ERROR_CONTEXT_LINES)
-        to_line = min(len(lines), line_no + self.ERROR_CONTEXT_LINES + 1)
+        to_line = line_no + self.ERROR_CONTEXT_LINES
 
+        # Templates can be large, so only read the lines we need rather than splitting the whole source
         code = []
-        for i in range(from_line, to_line):
-            line = "%4d : %s" % (i, lines[i - 1])
+        for i, source_line in enumerate(islice(io.StringIO(self.source), from_line - 1, to_line), from_line):
+            line = "%4d : %s" % (i, source_line.rstrip("\n"))
             if i == line_no:
                 line = f"[bold red]{line}[/bold red]"
             code.append(line)
@@ -122,19 +124,31 @@ class Template:
         self.provider = provider
         self.helpers = helpers
 
-    def render(self, vars: dict, fail_on_error: bool = False) -> str:
-        raw_template = str(self.provider.template(), "utf-8")
+    @cached_property
+    def source(self) -> str:
+        """
+        (Decoded) template source. Cached, as templates can be rendered more than once
+        """
+        return self.provider.template().decode("utf-8")
 
-        content = None
-        env = Environment(line_statement_prefix="##", undefined=StrictUndefined)
+    @cached_property
+    def compiled(self):
+        """
+        Compiled Jinja2 template. Cached so renders with different vars don't re-compile.
+        """
+        return load_template(str(self.provider), self.source)
+
+    def render(self, vars: dict, fail_on_error: bool = False) -> str:
+        raw_template = self.source
 
-        if self.helpers:
-            self.helpers.inject(env)
+        # Helpers are passed with the template context as the (shared) Jinja2 environment is used by
+        # all templates. Template vars take precedence, the same as they would over env.globals.
+        context = {**self.helpers.as_globals(), **vars} if self.helpers else vars
 
         content = None
         # This will fail if rendered template can't be processed via Jinja2 (e.g. undefined variable access etc)
         try:
-            content = env.from_string(source=raw_template).render(vars)
+            content = self.compiled.render(context)
 
             # "@@{{ some expression }}@@" is the same as {{ some expression }}
             #
@@ -1,56 +1,67 @@
 from __future__ import annotations
 
-import contextlib
 import hashlib
-import jinja2
 import json
 import os
 import re
-import shutil
 import tempfile
 import time
+import types
 import logging
 
 from dataclasses import dataclass
-from importlib import util as importutil
-from jinja2 import Environment
+from functools import cached_property
+from jinja2 import Template
 from os import path
-from pathlib import Path
 from typing import IO
 from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 
 from .human_bytes import HumanBytes
-from .cfn_bucket import CfnBucket, Uploadable
+from .cfn_bucket import CfnBucket, CfnBucketObject, Uploadable
 from .ignore_file import parse_ignore_list
 from .multipart_encoder import multipart_encode
+from .prefetch import prefetch
 from .config import Config
+from .jinja_env import TEMPLATE_ENV, compile_template, needs_rendering, render_plain
 
 log = logging.getLogger("template_helpers")
 
+_RESOURCIFY_SEP = re.compile(r"(_|-)+")
+_RESOURCIFY_WORD = re.compile(r"(\A|\W)+(\w)")
+# Fragments can't span lines, matching any of the line breaks str.splitlines() splits on
+_USERDATA_SPLIT = re.compile(r"<<([^\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]+?)>>(?!>)")
+
+
+def _set_compress_level(info: ZipInfo, level: int):
+    # ZipInfo.compress_level is public from Python 3.13, earlier versions only have the private attribute
+    if hasattr(info, "compress_level"):
+        info.compress_level = level
+    else:
+        info._compresslevel = level
+
+
+def _text_lines(text: str) -> list:
+    """
+    Splits user data text that precedes a << >> fragment into lines. The last item is the start of the
+    fragment's line, which is an empty string if the fragment starts the line.
+    """
+    lines = text.splitlines(keepends=True)
+    if not lines or lines[-1].splitlines() != [lines[-1]]:
+        lines.append("")
+    return lines
+
 
 @dataclass
 class ZipContent(Uploadable):
     name: str
     content: IO
-    md5sum: str
+    checksum: str
 
     def body(self) -> IO:
         return self.content
 
     def key(self) -> str:
-        return "/".join([self.name, self.md5sum + ".zip"])
-
-
-@contextlib.contextmanager
-def in_tmp_directory():
-    temp_dir = tempfile.mkdtemp()
-    try:
-        saved_dir = os.getcwd()
-        os.chdir(temp_dir)
-        yield
-    finally:
-        os.chdir(saved_dir)
-        shutil.rmtree(temp_dir)
+        return "/".join([self.name, self.checksum + ".zip"])
 
 
 class TemplateHelpers:
@@ -59,23 +70,25 @@ class TemplateHelpers:
         self.bucket = bucket
         self.config = config
         self.custom_helpers = {}
+        self._ignore_cache = {}
+        self._lambda_uploads = {}
+        self._cidr_cache = {}
+        self._template_cache = {}
 
         # These are "short-cuts" for use by custom helpers
         self.aws = config.aws
 
-        with in_tmp_directory():
-            os.mkdir("helpers")
-            for name in custom_helpers:
-                self.custom_helpers[name] = self._load_custom_helper(name)
+        for name in custom_helpers:
+            self.custom_helpers[name] = self._load_custom_helper(name)
 
-    def inject(self, env: Environment):
+    def as_globals(self) -> dict:
         """
-        Inject helpers into a Jinja2 environment. We have a set of core (standard) helpers that
-        should be useful for most projects.
-
-        Template projects can define custom helpers for domain-specific logic.
+        Returns dict of { name => helper } for use as Jinja2 globals. We have a set of core (standard)
+        helpers that should be useful for most projects, and template projects can define custom helpers
+        for domain-specific logic. Shared environments can't have per-template helpers injected, so these
+        are passed along with the template context instead.
         """
-        g = env.globals
+        g = {}
 
         # Core helpers
         g["resourcify"] = self.resourcify
@@ -93,6 +106,8 @@ class TemplateHelpers:
             # https://stackoverflow.com/questions/3431676/creating-functions-in-a-loop
             g[name] = self._make_helper_wrapper(func)
 
+        return g
+
     def _make_helper_wrapper(self, func):
         return lambda *args, **kwargs: func(self, *args, **kwargs)
 
@@ -100,36 +115,43 @@ class TemplateHelpers:
         """
         Given a string with non-alphanumeric characters, maps to a string that can be used as an AWS Resource name.
         """
-        return re.sub(r"(\A|\W)+(\w)", lambda m: m.group(2).upper(), re.sub(r"(_|-)+", " ", str(name))).replace(" ", "")
+        return _RESOURCIFY_WORD.sub(lambda m: m.group(2).upper(), _RESOURCIFY_SEP.sub(" ", str(name))).replace(" ", "")
 
     IGNORE_FILE = ".package-ignore"
 
     def lambda_uri(self, name: str) -> str:
-        lambda_path = path.join("functions", name)
-
-        zipped = self.zip_tree(dir=lambda_path, ignore=self.ignore_list(lambda_path))
-        return self.bucket.upload(zipped).as_s3()
+        return self._upload_lambda(name).as_s3()
 
     def lambda_code(self, name: str) -> dict:
-        lambda_path = path.join("functions", name)
-
-        zipped = self.zip_tree(dir=lambda_path, ignore=self.ignore_list(lambda_path))
-        uploaded = self.bucket.upload(zipped)
+        uploaded = self._upload_lambda(name)
 
         return {"S3Bucket": uploaded.bucket.bucket_name, "S3Key": uploaded.key}
 
+    def _upload_lambda(self, name: str) -> CfnBucketObject:
+        # Templates often reference the same function more than once (e.g. lambda_uri and lambda_code), so only zip and
+        # upload it once. Just the uploaded object is kept, so the zip itself can be freed once uploaded.
+        if name not in self._lambda_uploads:
+            lambda_path = path.join("functions", name)
+            zipped = self.zip_tree(dir=lambda_path, ignore=self.ignore_list(lambda_path), compresslevel=self.config.core.lambda_compress_level)
+            self._lambda_uploads[name] = self.bucket.upload(zipped)
+        return self._lambda_uploads[name]
+
     def ignore_list(self, p: str):
+        # The same function is commonly referenced more than once in a template (e.g. lambda_uri and lambda_code)
+        if p in self._ignore_cache:
+            return self._ignore_cache[p]
+
         provider = self.provider
 
         # Ignore files in $TEMPLATE_ROOT/$type/$name or $TEMPLATE_ROOT/$type
-        dir = Path(p)
-        ignore_files = [str(dir.parent / self.IGNORE_FILE), str(dir / self.IGNORE_FILE)]
+        ignore_files = [path.join(path.dirname(p), self.IGNORE_FILE), path.join(p, self.IGNORE_FILE)]
 
         # Make a merged ignore list (and also add the .package-ignore to the list)
         ignore_content = "\n".join([self.IGNORE_FILE] + [str(provider.content(p), "utf-8") for p in ignore_files if provider.is_file(p)])
 
         # Parse final list
-        return parse_ignore_list(ignore_content)
+        self._ignore_cache[p] = parse_ignore_list(ignore_content)
+        return self._ignore_cache[p]
 
     def user_data(self, name: str, **extra_vars) -> str:
         """
@@ -139,16 +161,12 @@ class TemplateHelpers:
         if not self.provider.is_tree(dir):
             raise (Exception(f"{dir} is not a directory"))
 
-        # Jinja2 evaluation requires any referenced variables be defined
-        # to avoid hard-to-detect failures.
-        env = jinja2.Environment(line_statement_prefix="##", undefined=jinja2.StrictUndefined)
-
         # context for template evalation is 'config.vars' plus any additional
         # parameters passed. E.g.
         #
         #     user_data(name='foo', param1='bar', param2='buzz')
         #
-        template_context = {**self.config.vars, **extra_vars}
+        template_context = self._template_context(extra_vars)
 
         # Build dict of { name => content } that we can encode
         parts = {}
@@ -157,7 +175,7 @@ class TemplateHelpers:
                 raise Exception("user_data(): %s is not a regular file" % part_name)
 
             # Userdata files are actually Jinja2 templates in disguise
-            template = env.from_string(source=str(content, "utf-8"))
+            template = self._compile(str(content, "utf-8"))
             parts[part_name] = template.render(template_context)
 
         encoded = multipart_encode(sorted(parts.items()))
@@ -171,13 +189,12 @@ class TemplateHelpers:
         # to a json array ["hello ", {"Ref": "bar"}, " there ", {}]
         #
         lines = []
-        for line in encoded.splitlines(keepends=True):
-            parts = re.split("<<(.+?)>>(?!>)", line)
-            for i, match in enumerate(parts):
-                if i % 2:
-                    lines.append(json.loads(match))
-                else:
-                    lines.append(match)
+        pos = 0
+        for match in _USERDATA_SPLIT.finditer(encoded):
+            lines += _text_lines(encoded[pos : match.start()])
+            lines.append(json.loads(match.group(1)))
+            pos = match.end()
+        lines += encoded[pos:].splitlines(keepends=True) or ([""] if pos else [])
 
         # Rendering user data as correctly indented content is hard, so
         # don't even bother - just dump out single-line JSON !
@@ -192,29 +209,54 @@ class TemplateHelpers:
         Find CIDR for subnet or VPC (AWS resources with a CIDR associated), otherwise
         just returns resource_id.
         """
-        ec2 = self.aws.resource("ec2")
         if resource_id.startswith("subnet-"):
-            return ec2.Subnet(resource_id).cidr_block
+            resource = self._ec2.Subnet
         elif resource_id.startswith("vpc-"):
-            return ec2.Vpc(resource_id).cidr_block
+            resource = self._ec2.Vpc
         else:
             # Maybe passed in a CIDR already
             return resource_id
 
+        # CIDRs don't change, so only look up each resource once
+        if resource_id not in self._cidr_cache:
+            self._cidr_cache[resource_id] = resource(resource_id).cidr_block
+        return self._cidr_cache[resource_id]
+
+    @cached_property
+    def _ec2(self):
+        # Templates are rendered on a single thread, so the resource can be re-used for every lookup
+        return self.aws.resource("ec2")
+
     def include_file(self, include_file_name, padding=8, prefix="\n", **extra_vars) -> str:
-        env = Environment(line_statement_prefix="##", undefined=jinja2.StrictUndefined)
+        content = str(self.provider.content(path.join("files", include_file_name)), "utf-8")
 
-        content = self.provider.content(path.join("files", include_file_name))
-        template = env.from_string(source=str(content, "utf-8"))
+        # Included files often have no Jinja2 syntax at all (e.g. scripts), in which case they're used as-is
+        if needs_rendering(content, TEMPLATE_ENV):
+            template = self._compile(content)
 
-        # context for evalation is 'config.vars' plus any additional parameters passed via
-        # :extra_vars:
-        result = template.render({**self.config.vars, **extra_vars})
+            # context for evalation is 'config.vars' plus any additional parameters passed via
+            # :extra_vars:
+            result = template.render(self._template_context(extra_vars))
+        else:
+            result = render_plain(content, TEMPLATE_ENV)
 
-        indended = "\n".join(map(lambda line: " " * padding + line, result.splitlines())) + "\n"
+        # Pad every line (including blank ones) by joining on newline + padding
+        lines = result.splitlines()
+        pad = " " * padding
+        indended = (pad + ("\n" + pad).join(lines) if lines else "") + "\n"
 
         return prefix + indended
 
+    def _compile(self, source: str) -> Template:
+        # Files are often included more than once, and are mostly too big for compile_template to cache
+        if source not in self._template_cache:
+            self._template_cache[source] = compile_template(source, TEMPLATE_ENV)
+        return self._template_cache[source]
+
+    def _template_context(self, extra_vars: dict) -> dict:
+        # Helpers are mostly called without extra vars, so don't copy config.vars unless needed (render doesn't modify it)
+        return {**self.config.vars, **extra_vars} if extra_vars else self.config.vars
+
     def upload_zip(self, dir: str, prefix: str = "", returns: str = "key") -> str:
         zipped = self.zip_tree(dir=dir, prefix=prefix)
 
@@ -228,67 +270,96 @@ class TemplateHelpers:
         else:
             raise Exception(f"Unknown 'returns' value {returns} - expect one of (key, s3-uri, http-uri)")
 
-    def zip_tree(self, dir: str, ignore=None, prefix="") -> ZipContent:
+    MAX_IN_MEMORY_ZIP_SIZE = 8 * 1024 * 1024
+
+    # Zip entries get a fixed timestamp (or SOURCE_DATE_EPOCH if set) so the same tree always gives the same zip.
+    # 1980-01-01 is the earliest date a zip can hold.
+    ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+    PREFETCH_FILES = 32
+
+    def zip_tree(self, dir: str, ignore=None, prefix="", compresslevel: int = None) -> ZipContent:
         """
-        Compress directory tree (root), setting prefix for files inside zip
+        Compress directory tree (root), setting prefix for files inside zip. compresslevel is the DEFLATE level
+        (0-9, default 6)
         """
         checksums = {}
 
-        tmp_file = tempfile.TemporaryFile()
-        with ZipFile(tmp_file, mode="w", compression=ZIP_DEFLATED) as zip:
+        date_time = self.ZIP_DATE_TIME
+        if os.environ.get("SOURCE_DATE_EPOCH"):
+            date_time = max(date_time, time.gmtime(int(os.environ["SOURCE_DATE_EPOCH"]))[:6])
+
+        # Most zips are small, so keep them in memory - only spilling to disk if they get large
+        tmp_file = tempfile.SpooledTemporaryFile(max_size=self.MAX_IN_MEMORY_ZIP_SIZE)
+        with ZipFile(tmp_file, mode="w", compression=ZIP_DEFLATED, compresslevel=compresslevel) as zip:
             log.info(f"Adding files from {dir}")
             count, size = 0, 0
-            for file_path, type, file_content in self.provider.find(dir, ignore):
+            # Files are found in a background thread so provider I/O overlaps with compression. For git this includes
+            # reading blobs, for the filesystem it's just walking the tree (files are read by opener() below).
+            for file_path, type, file_size, opener in prefetch(self.provider.find_openers(dir, ignore), self.PREFETCH_FILES):
                 # print(f"Processing {file_path} ({type})")
                 file_path = path.join(prefix, file_path)
 
                 # Add file to zip
-                info = ZipInfo(filename=file_path, date_time=time.localtime(time.time())[:6])
-                info.file_size = len(file_content)
+                info = ZipInfo(filename=file_path, date_time=date_time)
+                info.file_size = file_size
+                info.compress_type = ZIP_DEFLATED
+                # ZipFile only applies its compresslevel to entries it creates the ZipInfo for
+                _set_compress_level(info, compresslevel)
 
                 # Set file perm ugo=rx, preserve symlinks - 0xa000 (0x120000) bit
                 info.external_attr = (0o120755 if type == "symlink" else 0o555) << 16
 
-                zip.writestr(info, data=file_content, compress_type=ZIP_DEFLATED)
-
-                # Record md5 checksum
-                checksums[path.join(dir, file_path)] = hashlib.md5(str(file_content).encode("utf-8")).hexdigest()
+                # Write content to zip in chunks, and record checksum of content in the same pass
+                checksum = self._checksum()
+                with opener() as src, zip.open(info, mode="w") as dest:
+                    self._copy(src, dest, checksum)
+                checksums[path.join(dir, file_path)] = checksum.hexdigest()
 
                 count += 1
                 size += info.file_size
 
             log.info(f"Added {count} files, total {HumanBytes.format(size)}")
 
-        # final (composite) checksum is based on filenames and content md5s. They are sorted so checksum doesn't
+        # final (composite) checksum is based on filenames and content checksums. They are sorted so checksum doesn't
         # vary if files are discovered in different orders.
-        sorted_checksums = sorted(checksums.items())
-        md5sum = hashlib.md5(str(sorted_checksums).encode("utf-8")).hexdigest()
+        composite = self._checksum()
+        for file_path, checksum in sorted(checksums.items()):
+            composite.update(file_path.encode("utf-8") + b"\0" + checksum.encode("ascii") + b"\n")
 
         tmp_file.seek(0)  # required?
 
-        return ZipContent(dir, tmp_file, md5sum)
+        return ZipContent(dir, tmp_file, composite.hexdigest())
+
+    COPY_BUFFER_SIZE = 1024 * 1024
+
+    def _copy(self, src: IO, dest: IO, checksum):
+        """
+        Copy src to dest in chunks, updating checksum with content
+        """
+        while chunk := src.read(self.COPY_BUFFER_SIZE):
+            dest.write(chunk)
+            checksum.update(chunk)
+
+    def _checksum(self):
+        """
+        Checksums are only used to name uploaded zips, so use BLAKE2b (a little faster than OpenSSL's md5 on 64-bit
+        CPUs). A 16 byte digest keeps keys the same length as md5 ones.
+        """
+        return hashlib.blake2b(digest_size=16)
 
     def _load_custom_helper(self, name: str):
         """
-        TBH I don't really understand this, stolen from stack overflow 😱
+        Load helpers/<name>.py from the provider as a module, without writing it to disk
         """
         mod_name = f"stk.template_helpers.config.{name}"
 
-        mod_file = str(Path("helpers", name).with_suffix(".py"))
+        mod_file = path.join("helpers", f"{name}.py")
 
         content = self.provider.content(mod_file)
-        open(mod_file, "wb").write(content)
-
-        spec = importutil.spec_from_file_location(mod_name, mod_file)
-
-        if spec is None:
-            raise ImportError(f"Could not load spec for module '{mod_name}' at: {mod_file}")
 
-        module = importutil.module_from_spec(spec)
-        try:
-            spec.loader.exec_module(module)
-        except FileNotFoundError as e:
-            raise ImportError(f"{e.strerror}: {mod_file}") from e
+        module = types.ModuleType(mod_name)
+        module.__file__ = mod_file
+        exec(compile(content, mod_file, "exec"), module.__dict__)
 
         helper_func = getattr(module, "helper")
 
@@ -0,0 +1,11 @@
+from pytest import fixture
+
+from ..jinja_env import TEMPLATE_ENV
+
+
+@fixture(autouse=True)
+def bytecode_cache_dir(tmp_path, monkeypatch):
+    """Keep compiled templates out of the real cache directory"""
+    directory = str(tmp_path / "jinja")
+    monkeypatch.setattr(TEMPLATE_ENV.bytecode_cache, "directory", directory)
+    return directory
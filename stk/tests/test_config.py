@@ -140,3 +140,37 @@ class TestSimpleConfig(ConfigFixtures):
 class TestSimpleConfig(ConfigFixtures):
     def test_aws_vars(self, config, aws, sts):
         assert config.vars["account_id"] == 123456789012
+
+
+class TestVars:
+    def test_nested_interpolation(self):
+        vars = Config.Vars({"a": "{{ b }}-a", "b": "{{ c }}-b", "c": "c"})
+        assert vars == {"a": "c-b-a", "b": "c-b", "c": "c"}
+
+    def test_values_loaded_as_yaml(self):
+        vars = Config.Vars({"s": "hello world", "i": "12", "b": "yes", "n": "null", "m": "a: b", "c": "abc # comment"})
+        assert vars == {"s": "hello world", "i": 12, "b": True, "n": None, "m": {"a": "b"}, "c": "abc"}
+
+    def test_plain_values_match_rendered_values(self):
+        # Rendering drops a trailing newline, which matters for YAML block scalars. Values without Jinja2 syntax
+        # (which aren't rendered) must load the same as values that are.
+        values = {"a": "a: |\n  x\n", "b": "a: |+\n  x\n\n", "c": "a: |\r\n  x\r\n"}
+        rendered = {k: "{{ '' }}" + v for k, v in values.items()}
+        assert Config.Vars(values) == Config.Vars(rendered) == {"a": {"a": "x"}, "b": {"a": "x\n"}, "c": {"a": "x"}}
+        assert Config.InterpolatedDict(values, {}) == Config.InterpolatedDict(rendered, {})
+
+    def test_unresolvable_vars_raise(self):
+        with pytest.raises(Exception, match="An error occurred processing vars"):
+            Config.Vars({"a": "{{ b }}", "b": "{{ a }}"})
+
+
+class TestCoreSettings:
+    def test_stack_name_trailing_newline_invalid(self):
+        with pytest.raises(ValueError, match="is invalid"):
+            Config.CoreSettings(stack_name="a-stack\n")
+
+    def test_lambda_compress_level(self):
+        assert Config.CoreSettings(stack_name="a-stack").lambda_compress_level == 1
+        assert Config.CoreSettings(stack_name="a-stack", lambda_compress_level=9).lambda_compress_level == 9
+        with pytest.raises(ValueError, match="lambda_compress_level"):
+            Config.CoreSettings(stack_name="a-stack", lambda_compress_level=10)
@@ -17,3 +17,26 @@ class TestConfigFile(ConfigFixtures):
 
     def test_environments(self, config_file):
         assert config_file.environments() == ["dev", "test", "prod"]
+
+
+@pytest.mark.parametrize("config_file", ["environments-simple"], indirect=True)
+class TestConfigFiles(ConfigFixtures):
+    def test_fetch_all(self, config_file):
+        configs = config_file.load_includes()
+        sections = configs.fetch_all("test")
+
+        assert set(sections.keys()) == set(configs.DICT_KEYS + configs.SET_KEYS)
+        assert sections["vars"] == {
+            "a": "this is top-level environment - P1",
+            "b": "this is top-level default - P2",
+            "c": "this is included environment - P3",
+            "d": "this is included default - P4",
+        }
+        assert sections["params"] == {
+            "p1": "this is top-level environment param - P1",
+            "p2": "this is top-level default param - P2",
+            "p3": "this is included environment param - P3",
+            "p4": "this is included default param - P4",
+        }
+        assert sections["aws"] == {"region": "us-east-1", "cfn_bucket": "foo"}
+        assert sections["helpers"] == set()
@@ -0,0 +1,42 @@
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache
+
+from ..jinja_env import TEMPLATE_ENV, load_template
+
+
+class TestLoadTemplate:
+    def environment(self, directory: str):
+        env = Environment(bytecode_cache=FileSystemBytecodeCache(directory=directory))
+        compiled = []
+
+        # Record which sources actually get compiled
+        compile = env.compile
+        env.compile = lambda source, name=None, *args, **kwargs: compiled.append(source) or compile(source, name, *args, **kwargs)
+
+        return env, compiled
+
+    def test_cache_miss_then_hit(self, tmp_path):
+        env, compiled = self.environment(str(tmp_path))
+
+        assert load_template("main", "Hello {{ name }}", env).render(name="world") == "Hello world"
+        assert compiled == ["Hello {{ name }}"]
+        assert len(os.listdir(tmp_path)) == 1
+
+        # A new environment (e.g. the next run) re-uses the cached bytecode
+        env, compiled = self.environment(str(tmp_path))
+        assert load_template("main", "Hello {{ name }}", env).render(name="again") == "Hello again"
+        assert compiled == []
+
+    def test_changed_source_is_recompiled(self, tmp_path):
+        env, compiled = self.environment(str(tmp_path))
+        load_template("main", "Hello {{ name }}", env)
+
+        env, compiled = self.environment(str(tmp_path))
+        assert load_template("main", "Bye {{ name }}", env).render(name="world") == "Bye world"
+        assert compiled == ["Bye {{ name }}"]
+
+    def test_uses_environment_bytecode_cache_dir(self, bytecode_cache_dir):
+        load_template("test_uses_environment_bytecode_cache_dir", "{{ 1 }}")
+        assert TEMPLATE_ENV.bytecode_cache.directory == bytecode_cache_dir
+        assert len(os.listdir(bytecode_cache_dir)) == 1
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from ..prefetch import prefetch
+
+
+class TestPrefetch:
+    def test_items_in_order(self):
+        assert list(prefetch(range(1000), 4)) == list(range(1000))
+
+    def test_empty(self):
+        assert list(prefetch([], 4)) == []
+
+    def test_producer_exception_reraised(self):
+        def items():
+            yield 1
+            yield 2
+            raise ValueError("boom")
+
+        received = []
+        with pytest.raises(ValueError, match="boom"):
+            for item in prefetch(items(), 4):
+                received.append(item)
+
+        # Items produced before the error are still delivered
+        assert received == [1, 2]
+
+    def test_consumer_stopping_early_stops_producer(self):
+        produced = []
+
+        def items():
+            while True:
+                produced.append(len(produced))
+                yield produced[-1]
+
+        threads = threading.active_count()
+
+        for item in prefetch(items(), 4):
+            if item == 10:
+                break
+
+        # Producer thread has exited by the time the loop ends, having only got a queue's worth ahead of the consumer
+        assert threading.active_count() == threads
+        assert len(produced) <= 10 + 4 + 2
+
+    def test_consumer_error_waits_for_producer(self):
+        reading = threading.Event()
+
+        def items():
+            while True:
+                # Simulate a slow read
+                reading.set()
+                time.sleep(0.05)
+                reading.clear()
+                yield 1
+
+        with pytest.raises(ValueError):
+            for _ in prefetch(items(), 1):
+                raise ValueError("consumer failed")
+
+        # The producer isn't still reading once the consumer has stopped
+        assert not reading.is_set()
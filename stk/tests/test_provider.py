@@ -1,8 +1,25 @@
+from . import Fixtures
 from .. import provider
 
 
-class TestFileProvider:
-    pass
+class TestFileProvider(Fixtures):
+    def test_find_openers(self):
+        p = provider.FilesystemProvider(name="main", root=self.fixture_path("provider"))
+
+        found = {}
+        for file_path, type, size, opener in p.find_openers("tree"):
+            with opener() as f:
+                found[file_path] = (type, size, f.read())
+
+        assert found == {
+            "a.txt": ("file", 6, self.fixture_content("provider", "tree", "a.txt")),
+            "sub/b.txt": ("file", 7, self.fixture_content("provider", "tree", "sub", "b.txt")),
+            # Symlinks are returned as their target, rather than the content of the file they point to
+            "link": ("symlink", 5, b"a.txt"),
+        }
+
+        # find() returns the same content
+        assert {file_path: (type, content) for file_path, type, content in p.find("tree")} == {k: (v[0], v[2]) for k, v in found.items()}
 
 
 class TestGitLocalProvider:
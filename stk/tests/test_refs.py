@@ -96,8 +96,8 @@ class TestStackRefs(ConfigFixtures, StackFixtures):
             refs.output("some-other-stack", "unknown_output")
 
     def create_cfn_mock_response(self, refs):
-        # refs.stacks()
-        for name in refs.stacks().keys():
+        # refs.stacks
+        for name in refs.stacks.keys():
             # mock the cfn client
             stubber = Stubber(refs[name].cfn)
             expected_params = {"StackName": f"dev-{name}"}
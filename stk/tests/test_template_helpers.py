@@ -4,29 +4,29 @@ import json
 import zipfile
 
 from io import BytesIO
-from pytest import fixture
+from moto import mock_ec2
+from pytest import fixture, mark
 
 from . import StackFixtures
 from ..config import Config
-from ..provider import GenericProvider
+from ..human_bytes import HumanBytes
+from ..provider import FilesystemProvider, GenericProvider
 from ..template import RenderedTemplate, TemplateWithConfig
 from ..template_helpers import TemplateHelpers
+from .. import template_helpers
 from ..template_source import TemplateSource
 from ..cfn_bucket import CfnBucket
 
 
 class TestTemplateHelpers(StackFixtures):
-    @fixture
-    def env(self):
-        class FakeEnvironment:
-            def __init__(self):
-                self.globals = dict()
-
-        return FakeEnvironment()
-
     @fixture
     def config(self, sts):
-        return Config("main", environment="test", config_path=self.fixture_path("custom_helpers", "config"))
+        return Config(
+            "main",
+            environment="test",
+            config_path=self.fixture_path("custom_helpers", "config"),
+            template_path=self.fixture_path("custom_helpers", "templates"),
+        )
 
     @fixture
     def provider(self):
@@ -37,18 +37,18 @@ class TestTemplateHelpers(StackFixtures):
         assert set(config.helpers) == set(["a_custom_helper", "this_one_should_appear_only_once", "another_custom_helper"])
 
     @fixture
-    def basic_helpers(self, provider: GenericProvider, config: Config, env) -> TemplateHelpers:
+    def basic_helpers(self, provider: GenericProvider, config: Config) -> TemplateHelpers:
         return TemplateHelpers(provider=provider, bucket=None, custom_helpers=[], config=config)
 
-    def test_custom_helpers_loaded_from_provider(self, provider: GenericProvider, config: Config, env):
+    def test_custom_helpers_loaded_from_provider(self, provider: GenericProvider, config: Config):
         helpers = TemplateHelpers(provider=provider, bucket=None, custom_helpers=["a_custom_helper"], config=config)
 
-        helpers.inject(env)
+        helpers_globals = helpers.as_globals()
 
-        assert "a_custom_helper" in env.globals
-        assert env.globals["a_custom_helper"](41) == 42
+        assert "a_custom_helper" in helpers_globals
+        assert helpers_globals["a_custom_helper"](41) == 42
 
-    def test_custom_helpers_available_in_template(self, sts, provider: GenericProvider, config: Config, env):
+    def test_custom_helpers_available_in_template(self, sts, provider: GenericProvider, config: Config):
         template = TemplateWithConfig(provider=provider, config=config)
 
         rendered = template.render()
@@ -63,11 +63,62 @@ class TestTemplateHelpers(StackFixtures):
         helpers = TemplateHelpers(provider, bucket=bucket, custom_helpers=[], config=config)
 
         uri = helpers.lambda_uri("a_function")
-        assert uri.startswith("s3://foo/functions/a_function/6fa3f1707cb555571039137d7970816f.zip")
+        assert uri.startswith("s3://foo/functions/a_function/5ecefa7c1dfa25a49347ff202e448f7e.zip")
 
         uri2 = helpers.lambda_uri("a_function")
         assert uri == uri2, "Generated URLs are deterministic"
 
+    def test_resource_cidr(self, basic_helpers, config):
+        with mock_ec2():
+            ec2 = config.aws.client("ec2")
+            vpc_id = ec2.create_vpc(CidrBlock="10.1.0.0/16")["Vpc"]["VpcId"]
+            subnet_id = ec2.create_subnet(VpcId=vpc_id, CidrBlock="10.1.2.0/24")["Subnet"]["SubnetId"]
+
+            assert basic_helpers.resource_cidr(vpc_id) == "10.1.0.0/16"
+            assert basic_helpers.resource_cidr(subnet_id) == "10.1.2.0/24"
+            assert basic_helpers.resource_cidr("10.0.0.0/8") == "10.0.0.0/8"
+
+            # Lookups are cached
+            ec2.delete_subnet(SubnetId=subnet_id)
+            assert basic_helpers.resource_cidr(subnet_id) == "10.1.2.0/24"
+
+    def test_large_file_templates_compiled_once(self, tmp_path, config, monkeypatch):
+        (tmp_path / "files").mkdir()
+        (tmp_path / "files" / "big.sh").write_text("echo {{ 1 }}\n" * 1000)
+        helpers = TemplateHelpers(FilesystemProvider(name="main", root=str(tmp_path)), bucket=None, custom_helpers=[], config=config)
+
+        compiled = []
+        compile_template = template_helpers.compile_template
+        monkeypatch.setattr(template_helpers, "compile_template", lambda *args: compiled.append(args) or compile_template(*args))
+
+        assert helpers.include_file("big.sh") == helpers.include_file("big.sh")
+        assert len(compiled) == 1
+
+    def test_zip_tree_logs_total_size(self, tmp_path, config, caplog):
+        (tmp_path / "tree").mkdir()
+        for name in ["a", "b", "c"]:
+            (tmp_path / "tree" / name).write_bytes(b"x" * 100 * 1024)
+        helpers = TemplateHelpers(FilesystemProvider(name="main", root=str(tmp_path)), bucket=None, custom_helpers=[], config=config)
+
+        with caplog.at_level("INFO", logger="template_helpers"):
+            helpers.zip_tree("tree")
+
+        assert f"Added 3 files, total {HumanBytes.format(300 * 1024)}" in caplog.messages
+
+    def test_lambda_zipped_once(self, cfn_bucket, provider, config, monkeypatch):
+        helpers = TemplateHelpers(provider, bucket=CfnBucket(config.aws), custom_helpers=[], config=config)
+
+        zipped = []
+        zip_tree = helpers.zip_tree
+        monkeypatch.setattr(helpers, "zip_tree", lambda **kwargs: zipped.append(kwargs) or zip_tree(**kwargs))
+
+        uri = helpers.lambda_uri("a_function")
+        code = helpers.lambda_code("a_function")
+
+        # Both helpers refer to the same upload, but the function is only zipped once
+        assert uri == f"s3://{code['S3Bucket']}/{code['S3Key']}"
+        assert len(zipped) == 1
+
     def test_upload_zip(self, cfn_bucket, provider, config):
         bucket = CfnBucket(config.aws)
         helpers = TemplateHelpers(provider, bucket=bucket, custom_helpers=[], config=config)
@@ -76,12 +127,12 @@ class TestTemplateHelpers(StackFixtures):
         uri = helpers.upload_zip("files/test", prefix="/opt/foo")
 
         # Check it has correct url
-        assert uri == "files/test/15315fc306560b9eb8332fe277bf8e95.zip"
+        assert uri == "files/test/5043f0c6887e0c9bbf05c77e86be20a7.zip"
 
         # Download file from S3 and check the file is valid ZIP and it contains the
         # expected content
         s3 = config.aws.resource("s3")
-        object = s3.Object(cfn_bucket, "files/test/15315fc306560b9eb8332fe277bf8e95.zip")
+        object = s3.Object(cfn_bucket, "files/test/5043f0c6887e0c9bbf05c77e86be20a7.zip")
 
         content = object.get()["Body"].read()
         fh = BytesIO(content)
@@ -100,6 +151,37 @@ class TestTemplateHelpers(StackFixtures):
         assert 'Content-Type: text/x-shellscript; charset="utf-8"\n' in lines
         assert {"Ref": "SomeResource"} in lines
 
+    @mark.parametrize(
+        "content, expected",
+        [
+            ("echo hello\n", "\n        echo hello\n"),
+            ("echo {{ greeting }}\n", "\n        echo hello\n"),
+            # Rendering drops a single trailing newline, files without Jinja2 syntax must too
+            ("echo hello\n\n", "\n        echo hello\n"),
+            ("echo {{ greeting }}\n\n", "\n        echo hello\n"),
+            ("echo hello\r\n\r\n", "\n        echo hello\n"),
+            ("echo {{ greeting }}\r\n\r\n", "\n        echo hello\n"),
+            # '##' line statements, including on the first line and indented
+            ("## if true\necho hello\n## endif\n", "\n        echo hello\n"),
+            ("echo hello\n  ## if false\necho bye\n  ## endif\n", "\n        echo hello\n"),
+            ("echo ## not a statement\n", "\n        echo ## not a statement\n"),
+            # Padding: every line is padded, including blank ones, and output always ends with a newline
+            ("", "\n\n"),
+            ("{{ '' }}", "\n\n"),
+            ("a\n\n  b\n", "\n        a\n        \n          b\n"),
+            ("a\n{{ '' }}\n  b\n", "\n        a\n        \n          b\n"),
+            ("a", "\n        a\n"),
+            ("{{ greeting }}", "\n        hello\n"),
+        ],
+    )
+    def test_include_file(self, tmp_path, config, content, expected):
+        (tmp_path / "files").mkdir()
+        (tmp_path / "files" / "test.sh").write_bytes(content.encode("utf-8"))
+        helpers = TemplateHelpers(FilesystemProvider(name="main", root=str(tmp_path)), bucket=None, custom_helpers=[], config=config)
+
+        assert helpers.include_file("test.sh", greeting="hello") == expected
+        assert helpers.include_file("test.sh", padding=2, prefix="", greeting="hello") == expected[1:].replace(" " * 8, "  ")
+
     def test_package_ignore(self, provider, config):
         helpers = TemplateHelpers(provider, bucket=None, custom_helpers=[], config=config)
 
@@ -112,3 +194,6 @@ class TestTemplateHelpers(StackFixtures):
         assert not ignore("d")
 
         assert ignore(".package-ignore")
+
+        # Ignore lists are only loaded once per directory
+        assert helpers.ignore_list("functions/a_function") is ignore